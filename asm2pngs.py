@@ -23,66 +23,29 @@ Uso:
 
 from __future__ import annotations
 import argparse
+import functools
+import io
 import os
 import re
-from typing import Dict, List, Tuple, Optional
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Deque, Dict, FrozenSet, Iterable, List, Tuple, Optional, Union
+import numpy as np
 from PIL import Image
 
-# CPC firmware INK -> RGB (aprox 0/128/255 para 0/50/100)
-INK_RGB_PCT: Dict[int, Tuple[int, int, int]] = {
-    0:(0,0,0), 1:(0,0,50), 2:(0,0,100), 3:(50,0,0), 4:(50,0,50), 5:(50,0,100),
-    6:(100,0,0), 7:(100,0,50), 8:(100,0,100), 9:(0,50,0), 10:(0,50,50), 11:(0,50,100),
-    12:(50,50,0), 13:(50,50,50), 14:(50,50,100), 15:(100,50,0), 16:(100,50,50), 17:(100,50,100),
-    18:(0,100,0), 19:(0,100,50), 20:(0,100,100), 21:(50,100,0), 22:(50,100,50), 23:(50,100,100),
-    24:(100,100,0), 25:(100,100,50), 26:(100,100,100),
-}
-
-def pct_to_8bit(p: int) -> int:
-    if p == 0: return 0
-    if p == 50: return 128
-    if p == 100: return 255
-    return round(p * 255 / 100)
-
-INK_RGB: Dict[int, Tuple[int, int, int]] = {
-    k: tuple(pct_to_8bit(x) for x in v) for k, v in INK_RGB_PCT.items()
-}
-
-def decode_mode0(b: int) -> Tuple[int, int]:
-    p0 = 0
-    p1 = 0
-    p0 |= ((b >> 7) & 1) << 0
-    p1 |= ((b >> 6) & 1) << 0
-    p0 |= ((b >> 5) & 1) << 2
-    p1 |= ((b >> 4) & 1) << 2
-    p0 |= ((b >> 3) & 1) << 1
-    p1 |= ((b >> 2) & 1) << 1
-    p0 |= ((b >> 1) & 1) << 3
-    p1 |= ((b >> 0) & 1) << 3
-    return p0, p1
-
-def decode_mode1(b: int) -> Tuple[int, int, int, int]:
-    p0 = (((b >> 7) & 1) << 1) | (((b >> 3) & 1) << 0)
-    p1 = (((b >> 6) & 1) << 1) | (((b >> 2) & 1) << 0)
-    p2 = (((b >> 5) & 1) << 1) | (((b >> 1) & 1) << 0)
-    p3 = (((b >> 4) & 1) << 1) | (((b >> 0) & 1) << 0)
-    return p0, p1, p2, p3
-
-def decode_mode2(b: int) -> List[int]:
-    return [ (b >> (7 - i)) & 1 for i in range(8) ]
-
-def parse_num(token: str) -> Optional[int]:
-    token = token.strip().rstrip(",")
-    if not token:
-        return None
-    if token.startswith("&"):
-        return int(token[1:], 16)
-    if token.lower().startswith("0x"):
-        return int(token, 16)
-    if token.startswith("$"):
-        return int(token[1:], 16)
-    if re.fullmatch(r"-?\d+", token):
-        return int(token, 10)
-    return None
+from cpc_common import (
+    DATA_RE, MODE_DECODE, build_palette, iter_files, parse_db_values, print_summary_table,
+)
+
+# Una línea o es un label ("LABEL:" o "LABEL" solo, con una sola regex) o se recorre
+# una única vez con _LINE_SCAN_RE, que en el mismo barrido distingue INK pen,ink,
+# la directiva db/defb y el inicio de comentario (compiladas una sola vez).
+_LABEL_RE = re.compile(r"^\s*([A-Za-z_][A-Za-z0-9_]*)\s*(:)?\s*$")
+_LINE_SCAN_RE = re.compile(
+    # el lookahead descarta de golpe las posiciones que no empiezan por I, d o ';'
+    r"(?=[IiDd;])(?:(?P<ink>\bINK\s+(\d+)\s*,\s*(\d+)\b)|(?P<data>\b(?:db|defb)\b)|(?P<comment>;))",
+    re.IGNORECASE,
+)
 
 def sanitize_name(s: str) -> str:
     s = s.strip()
@@ -94,221 +57,229 @@ def sanitize_name(s: str) -> str:
         s = "IMG_" + s
     return s
 
-def parse_blocks_from_asm(text: str) -> List[Dict]:
+def _feed_block_line(block: Dict, line: str) -> None:
+    ink_m = None     # primer INK pen,ink (aunque esté comentado con ';' lo detectamos igual)
+    data_end = None  # fin de la primera directiva db/defb fuera de comentario
+    core_end = None  # posición del primer ';'
+    for m in _LINE_SCAN_RE.finditer(line):
+        kind = m.lastgroup
+        if kind == "ink":
+            if ink_m is None:
+                ink_m = m
+        elif kind == "data":
+            if data_end is None and core_end is None:
+                data_end = m.end()
+        elif core_end is None:
+            core_end = m.start()
+
+    if ink_m is not None:
+        block["pen_to_ink"][int(ink_m.group(2))] = int(ink_m.group(3))
+
+    # Datos db/defb (ignorando comentarios a partir de ';')
+    if data_end is not None:
+        block["db_bytes"].extend(parse_db_values(line[data_end:core_end]))
+
+def parse_blocks_from_asm(lines: Iterable[str]) -> List[Dict]:
     """
     Devuelve lista de bloques:
       {
         "label": str,
-        "db_bytes": List[int],        # números de db/defb en orden dentro del bloque
+        "db_bytes": bytearray,        # números de db/defb en orden dentro del bloque
         "pen_to_ink": Dict[int,int],  # INK detectado dentro del bloque (aunque esté comentado)
       }
 
+    `lines` puede ser el propio fichero abierto: se recorre una sola vez, hacia delante,
+    con un pequeño buffer de lookahead (también acepta el texto completo como str).
+
     Detecta labels en dos formatos:
     1) "LABEL:" (clásico)
     2) "LABEL" en una línea sola (como los .asm generados por pack_graficos_to_asm.py cuando se pidió sin ':')
        Heurística: línea con identificador y la siguiente línea relevante parece inicio de bloque (db/defb o marcador BEGIN IMAGE).
     """
-    lines = text.splitlines()
-
-    label_colon_re = re.compile(r"^\s*([A-Za-z_][A-Za-z0-9_]*)\s*:\s*$")
-    # label "solo" (sin ':') — una palabra identificador, sin espacios extras
-    label_solo_re = re.compile(r"^\s*([A-Za-z_][A-Za-z0-9_]*)\s*$")
-
-    data_re = re.compile(r"\b(db|defb)\b(.*)$", re.IGNORECASE)
-    ink_re = re.compile(r"\bINK\s+(\d+)\s*,\s*(\d+)\b", re.IGNORECASE)
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    it = iter(lines)
+    pending: Deque[str] = deque()  # líneas leídas por el lookahead y aún no procesadas
 
     blocks: List[Dict] = []
     current: Optional[Dict] = None
-    saw_any_label = False
+    # Datos previos al primer label: solo se usan si el archivo no tiene ningún label
+    orphan: Optional[Dict] = {"label": "IMG", "db_bytes": bytearray(), "pen_to_ink": {}}
 
     def start_block(lbl: str):
-        nonlocal current, blocks, saw_any_label
+        nonlocal current, orphan
         if current is not None:
             blocks.append(current)
-        current = {"label": lbl, "db_bytes": [], "pen_to_ink": {}}
-        saw_any_label = True
-
-    def next_relevant_line(idx: int) -> str:
-        # devuelve siguiente línea no vacía (incluye comentarios)
-        j = idx + 1
-        while j < len(lines):
-            s = lines[j].strip()
+        current = {"label": lbl, "db_bytes": bytearray(), "pen_to_ink": {}}
+        orphan = None
+
+    def next_relevant_line() -> str:
+        # devuelve siguiente línea no vacía (incluye comentarios), sin consumirla
+        for pl in pending:
+            s = pl.strip()
+            if s:
+                return s
+        for pl in it:
+            pending.append(pl)
+            s = pl.strip()
             if s:
                 return s
-            j += 1
         return ""
 
-    i = 0
-    while i < len(lines):
-        line = lines[i]
+    while True:
+        if pending:
+            line = pending.popleft()
+        else:
+            line = next(it, None)
+            if line is None:
+                break
+
+        m = _LABEL_RE.match(line)
 
         # 1) LABEL:
-        m = label_colon_re.match(line)
-        if m:
+        if m and m.group(2):
             start_block(m.group(1))
-            i += 1
             continue
 
         # 2) LABEL (solo) con heurística de lookahead
-        m = label_solo_re.match(line)
         if m:
             candidate = m.group(1)
             cand_low = candidate.lower()
 
             # Evitar falsos positivos: directivas / mnemonics / palabras comunes
             if cand_low not in ("db", "defb", "dw", "defw", "equ", "org", "include", "section", "macro", "endm"):
-                nxt = next_relevant_line(i)
+                nxt = next_relevant_line()
                 # Si la siguiente línea sugiere inicio de imagen/bloque, lo tomamos como label
                 # Ejemplos:
                 #   ;------ BEGIN IMAGE --------
                 #   db 8
                 #   defb &08,&18
-                if (nxt.startswith(";------") and "BEGIN" in nxt.upper()) or data_re.search(nxt):
+                if (nxt.startswith(";------") and "BEGIN" in nxt.upper()) or DATA_RE.search(nxt):
                     start_block(candidate)
-                    i += 1
                     continue
 
         # Si no hay bloque activo todavía, seguimos buscando label
+        # (guardando los datos por si el archivo no tiene ninguno)
         if current is None:
-            i += 1
+            _feed_block_line(orphan, line)
             continue
 
-        # INK (aunque esté comentado con ';' lo detectamos igual)
-        m_ink = ink_re.search(line)
-        if m_ink:
-            current["pen_to_ink"][int(m_ink.group(1))] = int(m_ink.group(2))
-
-        # Datos db/defb (ignorando comentarios a partir de ';')
-        core = line.split(";", 1)[0]
-        m_data = data_re.search(core)
-        if m_data:
-            tail = m_data.group(2)
-            tokens = re.findall(r"(&[0-9A-Fa-f]+|0x[0-9A-Fa-f]+|\$[0-9A-Fa-f]+|-?\d+)", tail)
-            for t in tokens:
-                n = parse_num(t)
-                if n is not None:
-                    current["db_bytes"].append(n & 0xFF)
-
-        i += 1
+        _feed_block_line(current, line)
 
     if current is not None:
         blocks.append(current)
 
-    if not saw_any_label:
+    if orphan is not None:
         # Sin labels: un único bloque con todo el archivo
-        pen_to_ink: Dict[int, int] = {}
-        db_bytes: List[int] = []
-        for line in lines:
-            m_ink = ink_re.search(line)
-            if m_ink:
-                pen_to_ink[int(m_ink.group(1))] = int(m_ink.group(2))
-            core = line.split(";", 1)[0]
-            m_data = data_re.search(core)
-            if not m_data:
-                continue
-            tail = m_data.group(2)
-            tokens = re.findall(r"(&[0-9A-Fa-f]+|0x[0-9A-Fa-f]+|\$[0-9A-Fa-f]+|-?\d+)", tail)
-            for t in tokens:
-                n = parse_num(t)
-                if n is not None:
-                    db_bytes.append(n & 0xFF)
-        blocks = [{"label": "IMG", "db_bytes": db_bytes, "pen_to_ink": pen_to_ink}]
+        blocks = [orphan]
 
     return blocks
 
+@functools.lru_cache(maxsize=64)
+def build_byte_rgba(pen_ink_items: FrozenSet[Tuple[int, int]], bg_ink: Optional[int], mode: int) -> bytes:
+    """
+    Tabla byte -> RGBA de sus píxeles (256 x px_per_byte x 4, uint8) para una paleta PEN->INK.
+    Se devuelve como bytes (inmutable) para poder memoizarla.
+    """
+    pen_to_ink = dict(pen_ink_items)
+
+    _, max_pens, lut = MODE_DECODE[mode]
+
+    palette = build_palette(pen_to_ink, bg_ink, max_pens)
+
+    # byte -> RGBA de sus píxeles: 256 entradas, una sola consulta por byte del bloque
+    return palette[lut].tobytes()
+
 def decode_block_to_png(
     block: Dict,
     mode: int,
-    out_path: str,
+    out_path: Union[str, BinaryIO],
     bg_ink: Optional[int] = None,
 ) -> Tuple[int, int]:
-    db_bytes: List[int] = block["db_bytes"]
+    db_bytes: bytearray = block["db_bytes"]
     if len(db_bytes) < 2:
         raise ValueError("bloque sin header (faltan width_bytes/height en db/defb)")
 
     width_bytes = db_bytes[0]
     height = db_bytes[1]
-    data = db_bytes[2:]
+    available = len(db_bytes) - 2
 
     needed = width_bytes * height
-    if len(data) < needed:
-        raise ValueError(f"datos insuficientes: necesito {needed} bytes y solo hay {len(data)}")
+    if available < needed:
+        raise ValueError(f"datos insuficientes: necesito {needed} bytes y solo hay {available}")
 
-    data = data[:needed]
     pen_to_ink: Dict[int, int] = block.get("pen_to_ink", {}) or {}
 
-    if mode == 0:
-        px_per_byte, max_pens = 2, 16
-    elif mode == 1:
-        px_per_byte, max_pens = 4, 4
-    else:
-        px_per_byte, max_pens = 8, 2
-
+    # La tabla solo depende de (paleta, bg_ink, modo): se comparte entre bloques
+    byte_rgba = np.frombuffer(
+        build_byte_rgba(frozenset(pen_to_ink.items()), bg_ink, mode), dtype=np.uint8
+    ).reshape(256, -1, 4)
+    px_per_byte = byte_rgba.shape[1]
     width_px = width_bytes * px_per_byte
 
-    def pen_to_rgba(pen: int) -> Tuple[int, int, int, int]:
-        if pen in pen_to_ink:
-            ink = pen_to_ink[pen]
-        else:
-            ink = bg_ink if bg_ink is not None else pen
-        ink = max(0, min(26, int(ink)))
-        r, g, b = INK_RGB.get(ink, (0, 0, 0))
-        return (r, g, b, 255)
-
-    img = Image.new("RGBA", (width_px, height))
-    pix = img.load()
-
-    i = 0
-    for y in range(height):
-        x = 0
-        for _ in range(width_bytes):
-            b = data[i] & 0xFF
-            i += 1
-            if mode == 0:
-                pens = list(decode_mode0(b))
-            elif mode == 1:
-                pens = list(decode_mode1(b))
-            else:
-                pens = decode_mode2(b)
-            for pen in pens:
-                if pen >= max_pens:
-                    pen = pen % max_pens
-                pix[x, y] = pen_to_rgba(pen)
-                x += 1
-
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    img.save(out_path)
+    # vista directa sobre el bytearray del bloque (sin copia)
+    data = np.frombuffer(db_bytes, dtype=np.uint8, count=needed, offset=2)
+    rgba = byte_rgba[data.reshape(height, width_bytes)].reshape(height, width_px, 4)
+
+    # la imagen comparte el buffer del array (sin copia)
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    img = Image.frombuffer("RGBA", (width_px, height), rgba, "raw", "RGBA", 0, 1)
+    # la carpeta destino la crea main una sola vez (todos los PNG van directos en out_dir);
+    # `out_path` también puede ser un fichero binario abierto (p.ej. io.BytesIO)
+    img.save(out_path, format="PNG")
     return width_px, height
 
 def iter_asms(root: str, recursive: bool) -> List[str]:
-    out: List[str] = []
-    if recursive:
-        for d, _, files in os.walk(root):
-            for f in files:
-                if f.lower().endswith(".asm"):
-                    out.append(os.path.join(d, f))
-    else:
-        for f in os.listdir(root):
-            if f.lower().endswith(".asm"):
-                out.append(os.path.join(root, f))
-    out.sort()
-    return out
+    return iter_files(root, recursive, ".asm")
 
 def print_summary(rows: List[Dict[str, str]]) -> None:
-    if not rows:
-        return
-    headers = ["ASM", "LABEL", "PNG", "SIZE(PX)", "STATUS"]
-    widths = {h: len(h) for h in headers}
-    for r in rows:
-        for h in headers:
-            widths[h] = max(widths[h], len(str(r.get(h, ""))))
-    def fmt_row(d):
-        return "  ".join(str(d.get(h, "")).ljust(widths[h]) for h in headers)
-    print("\nResumen:")
-    print(fmt_row({h:h for h in headers}))
-    print(fmt_row({h:"-"*widths[h] for h in headers}))
-    for r in rows:
-        print(fmt_row(r))
+    print_summary_table(rows, ["ASM", "LABEL", "PNG", "SIZE(PX)", "STATUS"])
+
+def process_one(asm_path: str, opts: Dict) -> Tuple[int, List[Dict[str, str]], List[Tuple[str, bytes]]]:
+    """
+    Convierte todos los bloques de un .asm a PNG, codificados en memoria (no escribe nada).
+    `opts` es un dict simple (pickleable) con asm_dir, out_dir, mode, bg_ink y prefix_file.
+    Returns: (nº de bloques, filas del resumen, [(ruta PNG, contenido PNG)])
+    """
+    asm_dir = opts["asm_dir"]
+    out_dir = opts["out_dir"]
+    summary: List[Dict[str, str]] = []
+    pngs: List[Tuple[str, bytes]] = []
+
+    asm_name = os.path.splitext(os.path.basename(asm_path))[0]
+    with open(asm_path, "r", encoding="utf-8", errors="ignore") as f:
+        blocks = parse_blocks_from_asm(f)
+
+    for b in blocks:
+        label = sanitize_name(b.get("label", "IMG")).upper()
+        if opts["prefix_file"]:
+            png_name = f"{sanitize_name(asm_name).upper()}__{label}.png"
+        else:
+            png_name = f"{label}.png"
+
+        out_path = os.path.join(out_dir, png_name)
+
+        try:
+            buf = io.BytesIO()
+            wpx, hpx = decode_block_to_png(b, opts["mode"], buf, bg_ink=opts["bg_ink"])
+            pngs.append((out_path, buf.getvalue()))
+            summary.append({
+                "ASM": os.path.relpath(asm_path, asm_dir),
+                "LABEL": label,
+                "PNG": os.path.relpath(out_path, out_dir),
+                "SIZE(PX)": f"{wpx}x{hpx}",
+                "STATUS": "OK",
+            })
+        except Exception as e:
+            summary.append({
+                "ASM": os.path.relpath(asm_path, asm_dir),
+                "LABEL": label,
+                "PNG": os.path.relpath(out_path, out_dir),
+                "SIZE(PX)": "-",
+                "STATUS": f"ERROR: {e}",
+            })
+
+    return len(blocks), summary, pngs
 
 def main():
     ap = argparse.ArgumentParser()
@@ -319,6 +290,8 @@ def main():
     ap.add_argument("--bg-ink", type=int, default=None, help="Si faltan INK pen,ink, usa este INK como fallback (si no, pen==ink)")
     ap.add_argument("--prefix-file", action="store_true",
                     help="Prefija el nombre del PNG con el nombre del .asm para evitar colisiones")
+    ap.add_argument("--jobs", type=int, default=None,
+                    help="Procesos en paralelo, uno por .asm (default: nº de CPUs; 1 = sin paralelismo)")
     args = ap.parse_args()
 
     asm_dir = args.asm_dir
@@ -333,47 +306,42 @@ def main():
 
     os.makedirs(out_dir, exist_ok=True)
 
+    opts = {
+        "asm_dir": asm_dir,
+        "out_dir": out_dir,
+        "mode": args.mode,
+        "bg_ink": args.bg_ink,
+        "prefix_file": args.prefix_file,
+    }
+
     summary: List[Dict[str, str]] = []
-    ok = 0
-    fail = 0
     total_blocks = 0
+    written = set()
+
+    def collect(results) -> None:
+        nonlocal total_blocks
+        # Los PNG se escriben aquí, en el orden de los .asm: si dos bloques van al mismo
+        # PNG (mismo label sin --prefix-file) gana siempre el último, como en serie
+        for n_blocks, rows, pngs in results:
+            for out_path, data in pngs:
+                if out_path in written:
+                    print(f"⚠️  {os.path.relpath(out_path, out_dir)}: sobrescrito (usa --prefix-file para evitar colisiones)")
+                written.add(out_path)
+                with open(out_path, "wb") as f:
+                    f.write(data)
+            total_blocks += n_blocks
+            summary.extend(rows)
+
+    # Cada .asm es independiente: se reparten entre procesos y se recogen en orden
+    jobs = min(args.jobs or os.cpu_count() or 1, len(asms))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as ex:
+            collect(ex.map(process_one, asms, [opts] * len(asms)))
+    else:
+        collect(process_one(p, opts) for p in asms)
 
-    for asm_path in asms:
-        asm_name = os.path.splitext(os.path.basename(asm_path))[0]
-        with open(asm_path, "r", encoding="utf-8", errors="ignore") as f:
-            text = f.read()
-
-        blocks = parse_blocks_from_asm(text)
-        total_blocks += len(blocks)
-
-        for b in blocks:
-            label = sanitize_name(b.get("label", "IMG")).upper()
-            if args.prefix_file:
-                png_name = f"{sanitize_name(asm_name).upper()}__{label}.png"
-            else:
-                png_name = f"{label}.png"
-
-            out_path = os.path.join(out_dir, png_name)
-
-            try:
-                wpx, hpx = decode_block_to_png(b, args.mode, out_path, bg_ink=args.bg_ink)
-                summary.append({
-                    "ASM": os.path.relpath(asm_path, asm_dir),
-                    "LABEL": label,
-                    "PNG": os.path.relpath(out_path, out_dir),
-                    "SIZE(PX)": f"{wpx}x{hpx}",
-                    "STATUS": "OK",
-                })
-                ok += 1
-            except Exception as e:
-                summary.append({
-                    "ASM": os.path.relpath(asm_path, asm_dir),
-                    "LABEL": label,
-                    "PNG": os.path.relpath(out_path, out_dir),
-                    "SIZE(PX)": "-",
-                    "STATUS": f"ERROR: {e}",
-                })
-                fail += 1
+    ok = sum(1 for r in summary if r["STATUS"] == "OK")
+    fail = len(summary) - ok
 
     print(f"\nASM encontrados: {len(asms)}  | Bloques: {total_blocks}  | PNG OK: {ok}  | Errores: {fail}")
     print(f"Salida PNG en: {os.path.abspath(out_dir)}")
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+cpc_common.py
+Constantes y utilidades compartidas por png2asm.py, asm2png.py y asm2pngs.py.
+
+- Paleta firmware CPC (INK -> RGB), también como array NumPy
+- Decodificado de bytes de pantalla MODE 0/1/2 (y sus tablas byte -> pens)
+- Parseo numérico de líneas db/defb y de comentarios INK pen,ink
+- Búsqueda de ficheros por extensión
+- Tabla de resumen en terminal
+"""
+
+from __future__ import annotations
+import os
+import re
+from typing import Dict, List, Tuple, Optional
+import numpy as np
+
+# Firmware ink -> (R%, G%, B%) 0/50/100 (aprox a 0/128/255)
+INK_RGB_PCT: Dict[int, Tuple[int, int, int]] = {
+    0:  (0,   0,   0),
+    1:  (0,   0,  50),
+    2:  (0,   0, 100),
+    3:  (50,  0,   0),
+    4:  (50,  0,  50),
+    5:  (50,  0, 100),
+    6:  (100, 0,   0),
+    7:  (100, 0,  50),
+    8:  (100, 0, 100),
+    9:  (0,  50,   0),
+    10: (0,  50,  50),
+    11: (0,  50, 100),
+    12: (50, 50,   0),
+    13: (50, 50,  50),
+    14: (50, 50, 100),
+    15: (100,50,   0),
+    16: (100,50,  50),
+    17: (100,50, 100),
+    18: (0, 100,   0),
+    19: (0, 100,  50),
+    20: (0, 100, 100),
+    21: (50,100,   0),
+    22: (50,100,  50),
+    23: (50,100, 100),
+    24: (100,100,  0),
+    25: (100,100, 50),
+    26: (100,100,100),
+}
+
+def pct_to_8bit(p: int) -> int:
+    if p == 0: return 0
+    if p == 50: return 128
+    if p == 100: return 255
+    return round(p * 255 / 100)
+
+INK_RGB: Dict[int, Tuple[int, int, int]] = {
+    k: tuple(pct_to_8bit(x) for x in v) for k, v in INK_RGB_PCT.items()
+}
+
+# Misma paleta indexable por INK: (27, 3) uint8
+INK_RGB_ARR = np.array([INK_RGB[i] for i in range(len(INK_RGB))], dtype=np.uint8)
+
+def decode_mode0(b: int) -> Tuple[int, int]:
+    p0 = 0
+    p1 = 0
+    p0 |= ((b >> 7) & 1) << 0
+    p1 |= ((b >> 6) & 1) << 0
+    p0 |= ((b >> 5) & 1) << 2
+    p1 |= ((b >> 4) & 1) << 2
+    p0 |= ((b >> 3) & 1) << 1
+    p1 |= ((b >> 2) & 1) << 1
+    p0 |= ((b >> 1) & 1) << 3
+    p1 |= ((b >> 0) & 1) << 3
+    return p0, p1
+
+def decode_mode1(b: int) -> Tuple[int, int, int, int]:
+    p0 = (((b >> 7) & 1) << 1) | (((b >> 3) & 1) << 0)
+    p1 = (((b >> 6) & 1) << 1) | (((b >> 2) & 1) << 0)
+    p2 = (((b >> 5) & 1) << 1) | (((b >> 1) & 1) << 0)
+    p3 = (((b >> 4) & 1) << 1) | (((b >> 0) & 1) << 0)
+    return p0, p1, p2, p3
+
+def decode_mode2(b: int) -> Tuple[int, ...]:
+    return tuple((b >> (7 - i)) & 1 for i in range(8))
+
+# byte -> pens (en orden de píxel), precalculado una vez para los 256 valores posibles.
+# decode_modeN solo usa desplazamientos y máscaras, así que se aplica tal cual sobre
+# el array con los 256 bytes: cada operación bit a bit recorre todos de una vez.
+_ALL_BYTES = np.arange(256, dtype=np.uint8)
+MODE0_LUT = np.stack(decode_mode0(_ALL_BYTES), axis=-1).astype(np.uint8)  # (256, 2)
+MODE1_LUT = np.stack(decode_mode1(_ALL_BYTES), axis=-1).astype(np.uint8)  # (256, 4)
+MODE2_LUT = np.stack(decode_mode2(_ALL_BYTES), axis=-1).astype(np.uint8)  # (256, 8)
+
+# MODE -> (px_per_byte, max_pens, tabla byte -> pens), para elegir el decodificador una vez
+# (por construcción los pens de cada tabla ya están en 0..max_pens-1)
+MODE_DECODE: Dict[int, Tuple[int, int, np.ndarray]] = {
+    0: (2, 16, MODE0_LUT),
+    1: (4, 4, MODE1_LUT),
+    2: (8, 2, MODE2_LUT),
+}
+
+def build_palette(pen_to_ink: Dict[int, int], bg_ink: Optional[int], max_pens: int) -> np.ndarray:
+    """
+    Paleta PEN -> RGBA (max_pens x 4, uint8).
+    Los PEN sin INK usan bg_ink (si no, pen==ink); el INK se limita a 0..26.
+    """
+    inks = np.array(
+        [pen_to_ink.get(pen, bg_ink if bg_ink is not None else pen) for pen in range(max_pens)],
+    )
+    inks = np.clip(inks, 0, len(INK_RGB_ARR) - 1)
+    full_alpha = np.full((max_pens, 1), 255, dtype=np.uint8)
+    return np.concatenate([INK_RGB_ARR[inks], full_alpha], axis=-1)
+
+# Expresiones regulares del parser (compiladas una sola vez)
+TOKEN_RE = re.compile(
+    r"&(?P<hexamp>[0-9A-Fa-f]+)|0x(?P<hex0x>[0-9A-Fa-f]+)|\$(?P<hexdol>[0-9A-Fa-f]+)|(?P<dec>-?\d+)"
+)
+DATA_RE = re.compile(r"\b(db|defb)\b(.*)$", re.IGNORECASE)
+INK_RE = re.compile(r"\bINK\s+(\d+)\s*,\s*(\d+)\b", re.IGNORECASE)
+
+def parse_db_values(tail: str) -> bytearray:
+    """Números de una línea db/defb (ya recortados a byte), en un solo barrido."""
+    vals = bytearray()
+    # findall devuelve una tupla por token con solo el grupo que ha casado relleno
+    for amp, hex0x, dol, dec in TOKEN_RE.findall(tail):
+        n = int(dec) if dec else int(amp or hex0x or dol, 16)
+        vals.append(n & 0xFF)
+    return vals
+
+def iter_files(root: str, recursive: bool, ext: str) -> List[str]:
+    """
+    Ficheros de `root` cuya extensión es `ext` (sin distinguir mayúsculas), ordenados.
+    Usa os.scandir: el tipo de cada entrada viene del propio listado, sin un stat extra.
+    """
+    ext = ext.lower()
+    out: List[str] = []
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            if d == root:
+                raise
+            continue  # como os.walk: subcarpetas ilegibles se ignoran
+        with it:
+            for e in it:
+                if recursive and e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                elif e.name.lower().endswith(ext) and e.is_file():
+                    out.append(e.path)
+    out.sort()
+    return out
+
+def print_summary_table(rows: List[Dict[str, str]], headers: List[str]) -> None:
+    """Tabla "Resumen:" con las columnas `headers` alineadas, en un solo print."""
+    if not rows:
+        return
+    cells = [[str(r.get(h, "")) for h in headers] for r in rows]
+    widths = [max(len(h), *(len(row[i]) for row in cells)) for i, h in enumerate(headers)]
+    def fmt_row(values):
+        return "  ".join(v.ljust(w) for v, w in zip(values, widths))
+    lines = ["\nResumen:", fmt_row(headers), fmt_row(["-" * w for w in widths])]
+    lines.extend(fmt_row(row) for row in cells)
+    print("\n".join(lines))
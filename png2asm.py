@@ -19,52 +19,16 @@ Salida ASM (por imagen):
 
 from __future__ import annotations
 import argparse
+import gzip
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, List, Tuple, Optional
+from typing import Callable, Dict, List, TextIO, Tuple, Optional
+import numpy as np
 from PIL import Image
 
-# Firmware ink -> (R%, G%, B%) 0/50/100 (aprox a 0/128/255)
-INK_RGB_PCT: Dict[int, Tuple[int, int, int]] = {
-    0:  (0,   0,   0),
-    1:  (0,   0,  50),
-    2:  (0,   0, 100),
-    3:  (50,  0,   0),
-    4:  (50,  0,  50),
-    5:  (50,  0, 100),
-    6:  (100, 0,   0),
-    7:  (100, 0,  50),
-    8:  (100, 0, 100),
-    9:  (0,  50,   0),
-    10: (0,  50,  50),
-    11: (0,  50, 100),
-    12: (50, 50,   0),
-    13: (50, 50,  50),
-    14: (50, 50, 100),
-    15: (100,50,   0),
-    16: (100,50,  50),
-    17: (100,50, 100),
-    18: (0, 100,   0),
-    19: (0, 100,  50),
-    20: (0, 100, 100),
-    21: (50,100,   0),
-    22: (50,100,  50),
-    23: (50,100, 100),
-    24: (100,100,  0),
-    25: (100,100, 50),
-    26: (100,100,100),
-}
-
-def pct_to_8bit(p: int) -> int:
-    if p == 0: return 0
-    if p == 50: return 128
-    if p == 100: return 255
-    return round(p * 255 / 100)
-
-INK_RGB: Dict[int, Tuple[int, int, int]] = {
-    k: tuple(pct_to_8bit(x) for x in v) for k, v in INK_RGB_PCT.items()
-}
+from cpc_common import INK_RGB, INK_RGB_ARR, iter_files, print_summary_table
 
 @dataclass
 class ModeSpec:
@@ -79,23 +43,41 @@ MODE_SPECS: Dict[int, ModeSpec] = {
     2: ModeSpec(2, 2,  8, 1),
 }
 
-def nearest_ink(rgb: Tuple[int, int, int], tol: int) -> int:
-    r, g, b = rgb
-    best = 0
-    best_d = 10**18
-    for ink, (ir, ig, ib) in INK_RGB.items():
-        dr = r - ir
-        dg = g - ig
-        db = b - ib
-        d = dr*dr + dg*dg + db*db
-        if d < best_d:
-            best_d = d
-            best = ink
-    if tol >= 0:
-        ir, ig, ib = INK_RGB[best]
-        if max(abs(r-ir), abs(g-ig), abs(b-ib)) > tol:
-            raise ValueError(f"Color {rgb} no coincide con paleta CPC (más cercano INK {best}={INK_RGB[best]})")
-    return best
+# Los 27 INK son todas las combinaciones de 3 niveles (0/128/255) por canal y la distancia
+# (euclídea en RGB) es una suma por canal: el INK más cercano sale de elegir el nivel más
+# cercano en cada canal por separado (en empate el menor, es decir, el INK de menor índice).
+# Dos tablas pequeñas, calculadas una vez, sustituyen al bucle sobre la paleta por píxel.
+_LEVELS = np.unique(INK_RGB_ARR).astype(np.int16)                                # (3,)
+_LEVEL_LUT = np.abs(np.arange(256, dtype=np.int16)[:, None] - _LEVELS).argmin(axis=1)   # (256,)
+_LEVELS_TO_INK = np.zeros((len(_LEVELS),) * 3, dtype=np.uint8)                    # (3, 3, 3)
+_LEVELS_TO_INK[tuple(np.searchsorted(_LEVELS, INK_RGB_ARR).T)] = np.arange(len(INK_RGB_ARR))
+
+# Tabla por canal con el nivel ya multiplicado por su paso en _LEVELS_TO_INK aplanada
+# (9, 3, 1): la suma de los tres canales es directamente el índice del INK, en uint8
+_LEVELS_TO_INK_FLAT = _LEVELS_TO_INK.ravel()
+_CHANNEL_LUTS = [
+    (_LEVEL_LUT * (stride // _LEVELS_TO_INK.itemsize)).astype(np.uint8)
+    for stride in _LEVELS_TO_INK.strides
+]
+
+# Distancia de cada valor de canal a su nivel más cercano: la misma que hay hasta el canal
+# del INK más cercano, así que la tolerancia se comprueba por canal sin volver a la paleta
+_LEVEL_DEV = np.abs(np.arange(256, dtype=np.int16) - _LEVELS[_LEVEL_LUT]).astype(np.uint8)  # (256,)
+
+def nearest_ink_grid(rgb: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    INK más cercano de cada píxel de una imagen entera: (H, W, 3) uint8 -> (H, W) INK.
+    Todo en buffers uint8 (h, w): `out` (si se pasa) y uno temporal, sin intermedios (H, W, 3).
+    """
+    if out is None:
+        out = np.empty(rgb.shape[:2], dtype=np.uint8)
+    tmp = np.empty_like(out)
+    # mode="clip": los índices ya están en rango y así `out` no pasa por un buffer intermedio
+    np.take(_CHANNEL_LUTS[0], rgb[..., 0], out=out, mode="clip")
+    for c in (1, 2):
+        np.take(_CHANNEL_LUTS[c], rgb[..., c], out=tmp, mode="clip")
+        out += tmp
+    return np.take(_LEVELS_TO_INK_FLAT, out, out=out, mode="clip")
 
 def pack_mode0(p0: int, p1: int) -> int:
     b = 0
@@ -127,137 +109,193 @@ def pack_mode2(pxs: List[int]) -> int:
         b |= (p & 1) << (7 - i)
     return b
 
-def to_rgba(img: Image.Image) -> Image.Image:
-    return img.convert("RGBA")
+def _pack_table(pack, ppb: int, colors: int) -> np.ndarray:
+    """(colors, ppb) uint8: bits que aporta cada PEN según su posición dentro del byte."""
+    table = np.zeros((colors, ppb), dtype=np.uint8)
+    for pen in range(colors):
+        for i in range(ppb):
+            pens = [0] * ppb
+            pens[i] = pen
+            table[pen, i] = pack(*pens)
+    return table
+
+# Mismos bits que pack_mode0/pack_mode1, precalculados una vez
+# (MODE 2 es MSB primero, un bit por píxel: lo hace np.packbits directamente)
+PACK_TABLES: Dict[int, np.ndarray] = {
+    0: _pack_table(pack_mode0, 2, 16),
+    1: _pack_table(pack_mode1, 4, 4),
+}
+
+def pack_pens(pen_grid: np.ndarray, spec: ModeSpec) -> np.ndarray:
+    """PENs (h, w) -> bytes de pantalla (h, w // px_per_byte) uint8, para toda la imagen."""
+    if spec.mode == 2:
+        return np.packbits(pen_grid.astype(np.uint8), axis=1)
+    h, w = pen_grid.shape
+    ppb = spec.px_per_byte
+    cells = pen_grid.reshape(h, w // ppb, ppb)
+    # los bits de cada posición no se solapan: el OR de sus aportaciones es el byte
+    return np.bitwise_or.reduce(PACK_TABLES[spec.mode][cells, np.arange(ppb)], axis=-1)
+
+def to_rgba(path: str) -> Image.Image:
+    """Abre el PNG (lectura con buffer) y lo devuelve en RGBA, sin convertir si ya lo está."""
+    with open(path, "rb", buffering=1 << 16) as fh:
+        img = Image.open(fh)
+        img.load()
+    return img if img.mode == "RGBA" else img.convert("RGBA")
+
+# Labels ASM válidos (compiladas una sola vez)
+_LABEL_BAD_CHARS_RE = re.compile(r"[^A-Za-z0-9_]")
+_LEAD_DIGIT_RE = re.compile(r"^\d")
 
 def safe_label(path: str, base_dir: str) -> str:
     rel = os.path.relpath(path, base_dir)
     rel_no_ext = os.path.splitext(rel)[0]
     s = rel_no_ext.replace(os.sep, "_")
-    s = re.sub(r"[^A-Za-z0-9_]", "_", s)
-    if re.match(r"^\d", s):
+    s = _LABEL_BAD_CHARS_RE.sub("_", s)
+    if _LEAD_DIGIT_RE.match(s):
         s = "img_" + s
     return s
 
 def iter_pngs(root: str, recursive: bool) -> List[str]:
-    out: List[str] = []
-    if recursive:
-        for d, _, files in os.walk(root):
-            for f in files:
-                if f.lower().endswith(".png"):
-                    out.append(os.path.join(d, f))
-    else:
-        for f in os.listdir(root):
-            if f.lower().endswith(".png"):
-                out.append(os.path.join(root, f))
-    out.sort()
-    return out
+    return iter_files(root, recursive, ".png")
 
 def convert_png_to_rows(
     png_path: str,
     spec: ModeSpec,
     tol: int,
     transparent_ink: Optional[int],
-) -> Tuple[int, int, List[List[int]], List[int], bool]:
+    warn: Callable[[str], None] = print,
+) -> Tuple[int, int, np.ndarray, List[int], bool]:
     """
     Returns:
-      width_bytes, height, rows(bytes), used_inks(list in order), auto_tol_used(bool)
+      width_bytes, height, rows(ndarray (height, width_bytes) uint8), used_inks(list in order), auto_tol_used(bool)
+    Los avisos (p.ej. fallback de tolerancia) se pasan a `warn`.
     """
-    img = to_rgba(Image.open(png_path))
+    img = to_rgba(png_path)
     w, h = img.size
 
     if w % spec.px_per_byte != 0:
         raise ValueError(f"ancho {w}px no divisible por {spec.px_per_byte} (MODE {spec.mode}).")
 
     width_bytes = w // spec.px_per_byte
-    px = img.load()
+    arr = np.asarray(img, dtype=np.uint8)  # (h, w, 4)
+    rgb = arr[..., :3]
+    alpha = arr[..., 3]
 
-    ink_grid: List[List[int]] = [[0]*w for _ in range(h)]
-    used_inks: List[int] = []
+    # INK más cercano de todos los píxeles de una vez
+    nearest = nearest_ink_grid(rgb)
     auto_tol_used = False
-    warned = False
-
-    def register_ink(i: int):
-        if i not in used_inks:
-            used_inks.append(i)
 
-    for y in range(h):
-        for x in range(w):
-            r, g, b, a = px[x, y]
-            if a == 0 and transparent_ink is not None:
-                ink = int(transparent_ink)
-            else:
-                try:
-                    ink = nearest_ink((r, g, b), tol)
-                except ValueError:
-                    # Fallback automático = equivalente a --tol -1
-                    ink = nearest_ink((r, g, b), -1)
-                    auto_tol_used = True
-                    if not warned:
-                        print(f"⚠️  {os.path.basename(png_path)}: color fuera de paleta -> fallback (equiv. --tol -1)")
-                        warned = True
-
-            ink_grid[y][x] = ink
-            register_ink(ink)
+    if tol >= 0:
+        # Píxeles fuera de tolerancia: se quedan con el más cercano (fallback = --tol -1).
+        # Algún canal a más de `tol` de su nivel, con una tabla de 256 bool y buffers (h, w)
+        off_lut = _LEVEL_DEV > tol
+        off = np.take(off_lut, rgb[..., 0], mode="clip")
+        tmp = np.empty_like(off)
+        for c in (1, 2):
+            off |= np.take(off_lut, rgb[..., c], out=tmp, mode="clip")
+        if transparent_ink is not None:
+            off &= alpha != 0
+        if off.any():
+            auto_tol_used = True
+            warn(f"⚠️  {os.path.basename(png_path)}: color fuera de paleta -> fallback (equiv. --tol -1)")
+
+    # Alpha=0 -> transparent_ink (si se ha pedido), escrito en el mismo buffer
+    ink_grid = nearest
+    if transparent_ink is not None:
+        np.putmask(ink_grid, alpha == 0, int(transparent_ink))
+
+    # INKs usados en orden de primera aparición (fila a fila)
+    inks, first = np.unique(ink_grid, return_index=True)
+    used_inks: List[int] = inks[np.argsort(first)].tolist()
 
     if len(used_inks) > spec.colors:
         raise ValueError(f"usa {len(used_inks)} INKs pero MODE {spec.mode} permite {spec.colors}.")
 
-    ink_to_pen: Dict[int, int] = {ink: pen for pen, ink in enumerate(used_inks)}
-
-    rows: List[List[int]] = []
-    for y in range(h):
-        row_bytes: List[int] = []
-        if spec.mode == 0:
-            for x in range(0, w, 2):
-                p0 = ink_to_pen[ink_grid[y][x]]
-                p1 = ink_to_pen[ink_grid[y][x+1]]
-                row_bytes.append(pack_mode0(p0, p1))
-        elif spec.mode == 1:
-            for x in range(0, w, 4):
-                p0 = ink_to_pen[ink_grid[y][x]]
-                p1 = ink_to_pen[ink_grid[y][x+1]]
-                p2 = ink_to_pen[ink_grid[y][x+2]]
-                p3 = ink_to_pen[ink_grid[y][x+3]]
-                row_bytes.append(pack_mode1(p0, p1, p2, p3))
-        else:
-            for x in range(0, w, 8):
-                ps = [ink_to_pen[ink_grid[y][x+i]] for i in range(8)]
-                row_bytes.append(pack_mode2(ps))
-        rows.append(row_bytes)
+    # INK -> PEN como tabla de 27 entradas: una sola consulta por píxel
+    pen_lut = np.zeros(len(INK_RGB), dtype=np.uint8)
+    pen_lut[used_inks] = np.arange(len(used_inks))
+    # (en el mismo buffer: el INK de cada píxel ya no hace falta)
+    pen_grid = np.take(pen_lut, ink_grid, out=ink_grid, mode="clip")
+
+    # Empaquetado de toda la imagen en un único array contiguo
+    rows = pack_pens(pen_grid, spec)
 
     return width_bytes, h, rows, used_inks, auto_tol_used
 
+def convert_job(
+    png_path: str,
+    spec: ModeSpec,
+    tol: int,
+    transparent_ink: Optional[int],
+) -> Tuple[Optional[Tuple], Optional[str], List[str]]:
+    """
+    convert_png_to_rows para un pool de procesos: ni imprime ni lanza excepciones,
+    así el proceso principal lo muestra todo en el orden de los PNG.
+    Returns: (resultado o None, error o None, avisos)
+    """
+    warnings: List[str] = []
+    try:
+        return convert_png_to_rows(png_path, spec, tol, transparent_ink, warnings.append), None, warnings
+    except Exception as e:
+        return None, str(e), warnings
+
+# str(b) de los 256 valores de byte, para no convertir cada byte al escribir
+_BYTE_STRS: Tuple[str, ...] = tuple(str(i) for i in range(256))
+
+def format_image_asm(
+    label: str,
+    width_bytes: int,
+    height: int,
+    rows: np.ndarray,
+    used_inks: List[int],
+    auto_tol_used: bool,
+) -> str:
+    """Bloque ASM completo de una imagen (se escribe con un solo write)."""
+    parts: List[str] = []
+    if auto_tol_used:
+        parts.append("; (nota) se usó fallback de tolerancia (equiv. --tol -1) en algún píxel\n")
+    parts.append(f"{label.upper()}\n")
+    parts.append(";------ BEGIN IMAGE --------\n")
+    parts.append(f"  db {width_bytes} ; ancho en bytes\n")
+    parts.append(f"  db {height} ; alto\n")
+    # row.tobytes() se recorre como ints sin crear escalares NumPy por byte
+    parts.extend("  db " + ", ".join([_BYTE_STRS[b] for b in row.tobytes()]) + "\n" for row in rows)
+    parts.append(";------ END IMAGE --------\n")
+    parts.append("  ; Paleta (PEN -> INK) detectada en el PNG\n")
+    parts.extend(f"  ; INK {pen},{ink}\n" for pen, ink in enumerate(used_inks))
+    parts.append("\n")
+    return "".join(parts)
+
+def open_asm_out(path: str) -> TextIO:
+    """Fichero ASM de salida (texto, utf-8); si termina en .gz se escribe comprimido con gzip."""
+    if path.lower().endswith(".gz"):
+        # nivel 1: casi todo el ahorro de disco con muy poco coste de CPU
+        return gzip.open(path, "wt", compresslevel=1, encoding="utf-8")
+    return open(path, "w", encoding="utf-8", buffering=1 << 20)
+
 def print_summary(rows: List[Dict[str, str]]) -> None:
-    if not rows:
-        return
-    headers = ["PNG", "Label", "Size(px)", "Bytes/line", "Colors", "Fallback", "Status"]
-    widths = {h: len(h) for h in headers}
-    for r in rows:
-        for h in headers:
-            widths[h] = max(widths[h], len(str(r.get(h, ""))))
-    def fmt_row(d):
-        return "  ".join(str(d.get(h, "")).ljust(widths[h]) for h in headers)
-    print("\nResumen:")
-    print(fmt_row({h:h for h in headers}))
-    print(fmt_row({h:"-"*widths[h] for h in headers}))
-    for r in rows:
-        print(fmt_row(r))
+    print_summary_table(rows, ["PNG", "Label", "Size(px)", "Bytes/line", "Colors", "Fallback", "Status"])
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--dir", default="GRAFICOS", help="Carpeta donde buscar PNGs (default: ./GRAFICOS)")
     ap.add_argument("--recursive", action="store_true", help="Busca PNGs recursivamente")
     ap.add_argument("--mode", type=int, choices=[0,1,2], required=True, help="Modo CPC (0/1/2)")
-    ap.add_argument("-o", "--out", required=True, help="Nombre del ASM de salida (se guardará dentro de ./ASM/)")
+    ap.add_argument("-o", "--out", required=True, help="Nombre del ASM de salida (se guardará dentro de ./ASM/; con .gz, comprimido)")
     ap.add_argument("--out-dir", default="ASM", help="Carpeta destino (default: ./ASM). Se crea si no existe.")
     ap.add_argument("--tol", type=int, default=8, help="Tolerancia RGB por canal (0 exacto). Si falla, fallback auto a -1.")
     ap.add_argument("--transparent-ink", type=int, default=None, help="Alpha=0 -> este INK (0..26)")
+    ap.add_argument("--jobs", type=int, default=None,
+                    help="Procesos en paralelo, uno por PNG (default: nº de CPUs; 1 = sin paralelismo)")
     args = ap.parse_args()
 
     spec = MODE_SPECS[args.mode]
     root = args.dir
 
+    if args.transparent_ink is not None and not 0 <= args.transparent_ink < len(INK_RGB):
+        raise SystemExit(f"--transparent-ink fuera de rango (0..{len(INK_RGB) - 1}): {args.transparent_ink}")
+
     if not os.path.isdir(root):
         raise SystemExit(f"No existe la carpeta: {root}")
 
@@ -272,37 +310,37 @@ def main():
     if not os.path.isabs(out_path):
         out_path = os.path.join(out_dir, out_path)
 
+    # Cada PNG es independiente: se convierten en paralelo y se escriben en orden
+    n = len(pngs)
+    job_args = (pngs, [spec] * n, [args.tol] * n, [args.transparent_ink] * n)
+    jobs = min(args.jobs or os.cpu_count() or 1, n)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as ex:
+            results = list(ex.map(convert_job, *job_args, chunksize=max(1, n // (jobs * 4))))
+    else:
+        results = list(map(convert_job, *job_args))
+
     summary: List[Dict[str, str]] = []
+    index_entries: List[Tuple[str, str]] = []  # (label, rel) para el índice final
     converted_ok = 0
     converted_fail = 0
 
-    with open(out_path, "w", encoding="utf-8") as f:
+    with open_asm_out(out_path) as f:
         f.write(f"; MODE {spec.mode}\n\n")
 
-        for path in pngs:
+        for path, (result, error, warnings) in zip(pngs, results):
+            for msg in warnings:
+                print(msg)
             rel = os.path.relpath(path, root)
             label = safe_label(path, root)
+            index_entries.append((label, rel))
 
-            try:
-                width_bytes, height, rows, used_inks, auto_tol_used = convert_png_to_rows(
-                    path, spec, args.tol, args.transparent_ink
-                )
+            if result is not None:
+                width_bytes, height, rows, used_inks, auto_tol_used = result
                 # Ancho en píxeles para resumen
                 width_px = width_bytes * spec.px_per_byte
 
-                if auto_tol_used:
-                    f.write("; (nota) se usó fallback de tolerancia (equiv. --tol -1) en algún píxel\n")
-                f.write(f"{label.upper()}\n")
-                f.write(f";------ BEGIN IMAGE --------\n")
-                f.write(f"  db {width_bytes} ; ancho en bytes\n")
-                f.write(f"  db {height} ; alto\n")
-                for row in rows:
-                    f.write("  db " + ", ".join(str(b) for b in row) + "\n")
-                f.write(f";------ END IMAGE --------\n")
-                f.write("  ; Paleta (PEN -> INK) detectada en el PNG\n")
-                for pen, ink in enumerate(used_inks):
-                    f.write(f"  ; INK {pen},{ink}\n")
-                f.write("\n")
+                f.write(format_image_asm(label, width_bytes, height, rows, used_inks, auto_tol_used))
 
                 summary.append({
                     "PNG": rel,
@@ -315,7 +353,7 @@ def main():
                 })
                 converted_ok += 1
 
-            except Exception as e:
+            else:
                 # No abortamos el pack completo: dejamos constancia y seguimos
                 summary.append({
                     "PNG": rel,
@@ -324,16 +362,13 @@ def main():
                     "Bytes/line": "-",
                     "Colors": "-",
                     "Fallback": "-",
-                    "Status": f"ERROR: {e}",
+                    "Status": f"ERROR: {error}",
                 })
                 converted_fail += 1
 
         # Índice de labels
         f.write("; --- Índice de labels ---\n")
-        for path in pngs:
-            rel = os.path.relpath(path, root)
-            label = safe_label(path, root)
-            f.write(f"; {label} = {rel}\n")
+        f.write("".join(f"; {label} = {rel}\n" for label, rel in index_entries))
 
     print(f"\nOK: {out_path}")
     print(f"PNGs encontrados: {len(pngs)}  | Convertidos OK: {converted_ok}  | Errores: {converted_fail}")